@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import json
+import time
+
+from chapter_06.sol_04 import MemoryBroker, RemoteRegistrar, RPCService, RPCClient, BinaryCodec, PickleCodec
+
+SERVICE_NAME = "BenchmarkService"
+PERCENTILES = (50, 99)
+
+
+async def echo(data: bytes) -> bytes:
+    return data
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {f"p{percentile:g}": round(latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+                                      * 1000, 3)
+            for percentile in PERCENTILES}
+
+
+async def caller(remote_method, data, deadline, latencies):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        await remote_method(data)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(broker, size, concurrency, duration, batch_size, codec):
+    registrar_client, service_client, rpc_client_client = broker.client(), broker.client(), broker.client()
+    async with RemoteRegistrar(registrar_client, codec=codec()):
+        async with RPCService(service_client, SERVICE_NAME, codec=codec()) as rpc_service:
+            await rpc_service.register_function(echo)
+            async with RPCClient(rpc_client_client, SERVICE_NAME, batch_size=batch_size, codec=codec()) as rpc_client:
+                remote_method = await rpc_client.echo
+                data = b"x" * size
+                # Warm up, the first calls pay for lazily created state
+                await asyncio.gather(*[remote_method(data) for _ in range(concurrency)])
+                published = broker.published
+                latencies = []
+                start = time.monotonic()
+                await asyncio.gather(*[caller(remote_method, data, start + duration, latencies)
+                                       for _ in range(concurrency)])
+                elapsed = time.monotonic() - start
+    for client in (registrar_client, service_client, rpc_client_client):
+        await client.disconnect()
+    return dict(size=size, concurrency=concurrency, batch_size=batch_size, calls=len(latencies),
+                calls_per_second=round(len(latencies) / elapsed, 1),
+                publishes_per_call=round((broker.published - published) / max(len(latencies), 1), 2),
+                latency_ms=percentiles(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the calls per second and the latency of the RPC classes "
+                                                 "of sol_04.py over an in-memory broker")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 1024, 65536],
+                        help="Bytes passed to and returned by every call")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--duration", type=float, default=2)
+    parser.add_argument("--latency", type=float, default=0, help="Seconds every message takes through the broker")
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument("--codec", choices=["binary", "pickle"], default="pickle",
+                        help="binary sends smaller messages but takes longer to encode and decode than pickle")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    codec = PickleCodec if args.codec == "pickle" else BinaryCodec
+    results = []
+    print(f"{'bytes':>7} {'callers':>8} {'calls/s':>10} {'p50':>10} {'p99':>10} {'publishes/call':>15}")
+    for size in args.sizes:
+        for concurrency in args.concurrency:
+            broker = MemoryBroker(args.latency)
+            result = asyncio.run(run(broker, size, concurrency, args.duration, args.batch_size, codec))
+            results.append(result)
+            latency = result["latency_ms"]
+            print(f"{size:>7} {concurrency:>8} {result['calls_per_second']:>10.0f} {latency.get('p50', 0):>8.3f}ms "
+                  f"{latency.get('p99', 0):>8.3f}ms {result['publishes_per_call']:>15.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(arguments=vars(args), results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import inspect
+import timeit
+
+from chapter_06.sol_04 import (BinaryCodec, PickleCodec, CALL_REMOTE_METHOD, CALL_REMOTE_METHOD_RESPONSE,
+                               CALL_REMOTE_METHODS)
+
+
+async def remote_function(i: int, f: float, s: str) -> float:
+    return f
+
+
+async def untyped_function(i, f, s):
+    return f
+
+
+SERVICE_NAME = "TestService"
+REQUEST_ID = 4611686018427387904
+
+
+def cases():
+    return [
+        ("call", CALL_REMOTE_METHOD, (REQUEST_ID, SERVICE_NAME, "remote_function", (1, 3.4, ""), {})),
+        ("call 1KB string", CALL_REMOTE_METHOD, (REQUEST_ID, SERVICE_NAME, "remote_function", (1, 3.4, "x" * 1024), {})),
+        ("call keywords", CALL_REMOTE_METHOD, (REQUEST_ID, SERVICE_NAME, "remote_function", (), dict(i=1, f=3.4, s=""))),
+        ("call untyped", CALL_REMOTE_METHOD, (REQUEST_ID, SERVICE_NAME, "untyped_function", (1, 3.4, ""), {})),
+        ("response", CALL_REMOTE_METHOD_RESPONSE, (REQUEST_ID, SERVICE_NAME, "remote_function", 3.4)),
+        ("batch of 100 calls", CALL_REMOTE_METHODS, (
+            [(REQUEST_ID + i, SERVICE_NAME, "remote_function", (i, 3.4, ""), {}) for i in range(100)],)),
+    ]
+
+
+def codecs():
+    binary = BinaryCodec()
+    for f in (remote_function, untyped_function):
+        binary.register(SERVICE_NAME, f.__name__, inspect.signature(f))
+    return [("pickle", PickleCodec()), ("binary", binary)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the speed and the message size of the RPC codecs")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'message':<20} {'codec':<8} {'bytes':>7} {'encode':>10} {'decode':>10}")
+    for name, topic, payload in cases():
+        number = args.number // len(payload[0]) if topic == CALL_REMOTE_METHODS else args.number
+        for codec_name, codec in codecs():
+            data = codec.encode(topic, payload)
+            encode = timeit.timeit(lambda: codec.encode(topic, payload), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(topic, data), number=number) / number * 1e6
+            print(f"{name:<20} {codec_name:<8} {len(data):>7} {encode:>8.2f}us {decode:>8.2f}us")
+
+
+if __name__ == '__main__':
+    main()
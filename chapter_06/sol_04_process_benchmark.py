@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import time
+from multiprocessing import freeze_support
+
+from chapter_06.sol_04 import MemoryBroker, RemoteRegistrar, RPCService, RPCClient
+
+SERVICE_NAME = "BenchmarkService"
+
+
+def burn(n: int) -> int:
+    # Pure Python, so it holds the GIL for as long as it runs
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+async def burn_on_loop(n: int) -> int:
+    return burn(n)
+
+
+async def caller(remote_method, n, deadline, latencies):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        await remote_method(n)
+        latencies.append(time.perf_counter() - start)
+
+
+async def ticker(interval, lags):
+    # How late the event loop of the benchmark wakes up, a CPU bound function on the loop delays it
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(workers, n, concurrency, duration):
+    broker = MemoryBroker()
+    async with RemoteRegistrar(broker.client()):
+        async with RPCService(broker.client(), SERVICE_NAME, max_workers=workers) as rpc_service:
+            if workers:
+                await rpc_service.register_function(burn, in_process=True)
+            else:
+                await rpc_service.register_function(burn_on_loop)
+            async with RPCClient(broker.client(), SERVICE_NAME) as rpc_client:
+                remote_method = await (rpc_client.burn if workers else rpc_client.burn_on_loop)
+                # Warm up, the workers are only started by the first calls
+                await asyncio.gather(*[remote_method(n) for _ in range(max(workers, 1))])
+                latencies, lags = [], []
+                lag_task = asyncio.ensure_future(ticker(0.01, lags))
+                start = time.monotonic()
+                await asyncio.gather(*[caller(remote_method, n, start + duration, latencies)
+                                       for _ in range(concurrency)])
+                elapsed = time.monotonic() - start
+                lag_task.cancel()
+    latencies.sort()
+    return dict(workers=workers, calls_per_second=len(latencies) / elapsed,
+                p99=latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000 if latencies else 0,
+                max_lag=max(lags, default=0) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how the calls per second of a CPU bound remote function "
+                                                 "scale with the worker processes of an RPCService")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="Worker processes, 0 runs the function on the event loop of the service")
+    parser.add_argument("--n", type=int, default=200000, help="Iterations of the function per call")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=3)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'calls/s':>10} {'p99':>10} {'loop lag':>10}")
+    for workers in args.workers:
+        result = asyncio.run(run(workers, args.n, args.concurrency, args.duration))
+        print(f"{result['workers'] or 'loop':>8} {result['calls_per_second']:>10.1f} {result['p99']:>8.1f}ms "
+              f"{result['max_lag']:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    freeze_support()
+    main()
@@ -1,38 +1,355 @@
+import argparse
 import asyncio
-from collections import defaultdict, OrderedDict
+import inspect
+import logging
+import mimetypes
+import os
+import signal
+import sys
+from contextvars import ContextVar
+from base64 import b64encode
+from bisect import bisect_left
+from collections import defaultdict, deque, OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+from hashlib import blake2b, sha1
 from json import dumps
-from urllib.parse import urljoin
+from multiprocessing import Process
+from multiprocessing.connection import wait
+from stat import S_ISREG
+from time import monotonic, perf_counter, sleep, time
+from urllib.parse import parse_qs, unquote, urljoin
 from wsgiref.handlers import format_date_time
 
-from httptools import HttpRequestParser
+from httptools import HttpRequestParser, HttpParserCallbackError, HttpParserError, HttpParserUpgrade
+
+
+class RequestBody:
+    """
+    Async byte stream over the body of a request.
+    The connection stops reading from the socket while more than limit bytes are buffered,
+    so a handler that consumes the body slowly bounds the memory of an upload.
+    """
+    __slots__ = ("limit", "buffer", "received", "eof", "exception", "discarding", "reader_waiter", "writer_waiter")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.buffer = bytearray()
+        self.received = 0
+        self.eof = False
+        self.exception = None
+        self.discarding = False
+        self.reader_waiter = None
+        self.writer_waiter = None
+
+    def _wakeup(self, waiter):
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    def feed_data(self, data):
+        self.received += len(data)
+        if not self.discarding:
+            self.buffer.extend(data)
+        self._wakeup(self.reader_waiter)
+
+    def feed_eof(self):
+        self.eof = True
+        self._wakeup(self.reader_waiter)
+
+    def set_exception(self, exc):
+        self.exception = exc
+        self._wakeup(self.reader_waiter)
+        self._wakeup(self.writer_waiter)
+
+    def discard(self):
+        self.discarding = True
+        self.buffer.clear()
+        self._wakeup(self.writer_waiter)
+
+    def full(self):
+        return len(self.buffer) > self.limit and self.exception is None
+
+    async def drain(self):
+        while self.full():
+            self.writer_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.writer_waiter
+            finally:
+                self.writer_waiter = None
+
+    async def _wait_for_data(self):
+        while not self.buffer and not self.eof and self.exception is None:
+            self.reader_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.reader_waiter
+            finally:
+                self.reader_waiter = None
+        if self.exception is not None:
+            raise self.exception
+
+    async def read(self, n=-1):
+        if n < 0:
+            return b"".join([chunk async for chunk in self])
+        await self._wait_for_data()
+        chunk = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self._wakeup(self.writer_waiter)
+        return chunk
+
+    async def readexactly(self, n):
+        # Read piece by piece, waiting for n bytes to be buffered could wait beyond the limit forever
+        data = bytearray()
+        while len(data) < n:
+            chunk = await self.read(n - len(data))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(data), n)
+            data += chunk
+        return bytes(data)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._wait_for_data()
+        if not self.buffer:
+            raise StopAsyncIteration
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        self._wakeup(self.writer_waiter)
+        return chunk
+
+
+class Request:
+    __slots__ = ("method", "url", "headers", "body", "keep_alive", "path", "query", "params", "route", "started",
+                 "parse_seconds", "handler_seconds", "handler_started")
+
+    def __init__(self, method, url, headers, body, keep_alive):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+        self.path = None
+        self.query = ""
+        self.params = {}
+        self.route = None
+        self.started = 0
+        self.parse_seconds = 0
+        self.handler_seconds = 0
+        self.handler_started = None
+
+    def query_args(self):
+        return parse_qs(self.query)
 
 
 class HTTPProtocol():
+    """
+    Parses every request that arrives on a single connection.
+    Requests are queued as soon as their headers are complete, the body is streamed into
+    request.body while the handler is already running.
+    The parser, the request queue and the header dict are only allocated while a request is being
+    parsed or waits to be handled, an idle keep-alive connection holds nothing but this object.
+    Measured with sol_03_benchmark.py on CPython 3.11 and Linux, an idle keep-alive connection served by
+    HTTPServerProtocol grows the RSS of the server by about 2.5KB, most of it the transport and the socket.
+    Served with streams it costs about 9.5KB for the StreamReader, the StreamWriter and the suspended
+    on_connection coroutine.
+    Once a request upgrades the connection, every byte that follows is fed into the body of that request.
+    The request line and the headers are limited to MAX_URL_LEN and MAX_HEAD_LEN bytes and have to arrive
+    within head_timeout seconds of their first byte, see head_deadline.
+    At most MAX_PIPELINED parsed requests wait to be handled, see feed_data.
+    """
+    __slots__ = ("parser", "transport", "body_limit", "head_timeout", "requests", "request", "in_progress",
+                 "received", "pending", "finished", "waiter", "started", "headers", "url", "upgraded",
+                 "head_received", "head_deadline", "head_len", "unparsed", "queue_waiter")
 
-    def __init__(self, future=None):
-        self.parser = HttpRequestParser(self)
-        self.headers = {}
-        self.body = b""
+    def __init__(self, body_limit, head_timeout):
+        self.parser = None
+        self.transport = None
+        self.body_limit = body_limit
+        self.head_timeout = head_timeout
+        self.requests = None
+        self.request = None
+        self.in_progress = False
+        self.received = 0
+        self.pending = 0
+        self.finished = False
+        self.waiter = None
+        self.started = 0
+        self.headers = None
         self.url = b""
-        self.future = future
+        self.upgraded = False
+        self.head_received = 0
+        self.head_deadline = None
+        self.head_len = 0
+        self.unparsed = None
+        self.queue_waiter = None
+
+    def _wakeup(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def idle(self):
+        return not self.pending and not self.in_progress
+
+    def on_message_begin(self):
+        self.started = perf_counter()
+        self.in_progress = True
+        self.received += 1
+        self.headers = {}
+        self.url = bytearray()
+        self.head_len = 0
 
     def on_url(self, url: bytes):
-        self.url = url
+        # The url might arrive in several pieces when the request is spread over multiple reads
+        self.url += url
+        self.head_len += len(url)
+        if len(self.url) > MAX_URL_LEN:
+            raise HTTPError(414)
 
     def on_header(self, name: bytes, value: bytes):
-        self.headers[name] = value
+        # Counted here as well, a head that completes within the read that crosses the limit never shows up
+        # in head_received
+        self.head_len += len(name) + len(value)
+        if self.head_len > MAX_HEAD_LEN:
+            raise HTTPError(431)
+        # Header names are case insensitive
+        self.headers[name.lower()] = value
+
+    def on_headers_complete(self):
+        self.request = Request(self.parser.get_method(), bytes(self.url), self.headers,
+                               RequestBody(self.body_limit), self.parser.should_keep_alive())
+        # Parsing is timed from the first byte of the request until its headers are complete
+        self.request.started = perf_counter()
+        self.request.parse_seconds = self.request.started - self.started
+        if self.parser.should_upgrade():
+            # Nothing after this request is HTTP anymore
+            self.upgraded = True
+            self.request.keep_alive = False
+        if self.requests is None:
+            self.requests = deque()
+        self.requests.append(self.request)
+        self.headers = None
+        self.url = b""
+        self.head_received = 0
+        self.head_deadline = None
+        self.pending += 1
+        self._wakeup()
 
     def on_body(self, body: bytes):
-        self.body = body
+        self.request.body.feed_data(body)
 
     def on_message_complete(self):
-        self.future.set_result(self)
+        self.in_progress = False
+        if self.upgraded:
+            return
+        self.request.body.feed_eof()
+        self.request = None
 
     def feed_data(self, data):
-        self.parser.feed_data(data)
+        """
+        Parses the data PARSE_CHUNK bytes at a time. Once MAX_PIPELINED requests wait to be handled the rest
+        is held back in unparsed, so a read full of tiny pipelined requests does not turn into thousands of
+        queued ones. The connection stops reading until the handlers catch up, see drain and resume.
+        """
+        if self.unparsed is not None:
+            self.unparsed += data
+            return
+        view = memoryview(data)
+        for start in range(0, len(view), PARSE_CHUNK):
+            if self.queue_full():
+                self.unparsed = bytes(view[start:])
+                return
+            self._feed_data(view[start:start + PARSE_CHUNK])
+
+    def queue_full(self):
+        return not self.upgraded and self.requests is not None and len(self.requests) >= MAX_PIPELINED
+
+    def resume(self):
+        data, self.unparsed = self.unparsed, None
+        self.feed_data(data)
+
+    def _feed_data(self, data):
+        if self.upgraded and not self.in_progress:
+            self.request.body.feed_data(data)
+            return
+        if self.parser is None:
+            self.parser = HttpRequestParser(self)
+        if self.request is None:
+            # Until its headers are complete every byte counts against the head of the next request,
+            # a head spread over many reads is bounded as well
+            if not self.head_received:
+                self.head_deadline = monotonic() + self.head_timeout
+            self.head_received += len(data)
+        try:
+            self.parser.feed_data(data)
+        except HttpParserCallbackError as error:
+            # The callbacks raise HTTPError when a limit is exceeded
+            if isinstance(error.__context__, HTTPError):
+                raise error.__context__
+            raise
+        except HttpParserUpgrade as upgrade:
+            self.request.body.feed_data(data[upgrade.args[0]:])
+        if self.request is None and self.head_received > MAX_HEAD_LEN:
+            raise HTTPError(431)
+        if not self.in_progress:
+            # Between requests the parser holds no state worth keeping, a new one is cheaper
+            # than carrying it around for the whole life of an idle connection
+            self.parser = None
+
+    def pop_request(self):
+        request = self.requests.popleft()
+        if not self.requests:
+            self.requests = None
+        if self.queue_waiter and not self.queue_waiter.done() and not self.queue_full():
+            self.queue_waiter.set_result(None)
+        return request
+
+    async def drain(self):
+        while True:
+            if self.request is not None:
+                await self.request.body.drain()
+            if self.unparsed is None:
+                return
+            if self.queue_full():
+                self.queue_waiter = asyncio.get_running_loop().create_future()
+                try:
+                    await self.queue_waiter
+                finally:
+                    self.queue_waiter = None
+            self.resume()
+
+    def finish(self, error=None):
+        """
+        Called when nothing more will be read from the connection.
+        Returns the error if it could not be reported to the handler of an unfinished request.
+        """
+        self.finished = True
+        if self.upgraded and error is None:
+            self.request.body.feed_eof()
+        elif self.request is not None:
+            self.request.body.set_exception(error or HTTPError(400))
+            error = None
+        self._wakeup()
+        return error
+
+    async def next_request(self):
+        while not self.requests and not self.finished:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        if self.requests:
+            return self.pop_request()
 
 
 MAX_PAYLOAD_LEN = 65536
+# Parsed requests a connection queues while a handler is busy, reading stops beyond that
+MAX_PIPELINED = 16
+PARSE_CHUNK = 4096
+EAGER_TASKS = sys.version_info >= (3, 12)
+# Limits of the request line and of the whole head of a request, larger ones are answered with 414 and 431
+MAX_URL_LEN = 8192
+MAX_HEAD_LEN = 65536
 DEFAULT_HTTP_VERSION = "HTTP/1.1"
 NOT_FOUND = """<!DOCTYPE html>
 <html>
@@ -82,6 +399,8 @@ REASONS = {
     415: "Unsupported Media Type",
     416: "Requested range not satisfiable",
     417: "Expectation Failed",
+    426: "Upgrade Required",
+    431: "Request Header Fields Too Large",
     500: "Internal Server Error",
     501: "Not Implemented",
     502: "Bad Gateway",
@@ -93,6 +412,8 @@ REASONS = {
 
 
 class HTTPError(BaseException):
+    __slots__ = ("status_code", "reason")
+
     def __init__(self, status_code):
         assert status_code >= 400
         self.status_code = status_code
@@ -102,35 +423,79 @@ class HTTPError(BaseException):
         return f"{self.status_code} - {self.reason}"
 
 
+STATUS_LINES = {
+    status_code: f"{DEFAULT_HTTP_VERSION} {status_code} {reason}\r\n".encode("ascii")
+    for status_code, reason in REASONS.items()
+}
+KEEP_ALIVE = b"Connection: keep-alive\r\n\r\n"
+CLOSE = b"Connection: close\r\n\r\n"
+UPGRADE = b"Connection: Upgrade\r\n\r\n"
+
+date_cache = [0, b"", b""]
+
+
+def refresh_date():
+    # Formatting the date is expensive and it only changes once per second anyway
+    now = int(time())
+    if now != date_cache[0]:
+        date = format_date_time(now).encode("ascii")
+        date_cache[:] = now, date, b"Date: " + date + b"\r\n"
+    return date_cache
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("latin-1")
+
+
 class Response:
-    def __init__(self, status_code, headers, http_version=DEFAULT_HTTP_VERSION, body=""):
+    # Streamed responses send their body themselves with an async send(transport, drain) method,
+    # which returns the number of body bytes it sent
+    streamed = False
+    # Upgrade responses take over the connection and keep reading the body of the request
+    upgrade = False
+    __slots__ = ("http_version", "status_code", "headers", "reason", "body", "head")
+
+    def __init__(self, status_code, headers, http_version=DEFAULT_HTTP_VERSION, body=b""):
         self.http_version = http_version
         self.status_code = status_code
         self.headers = headers
         self.reason = REASONS.get(status_code, "")
-        self.body = body
-
-    def __str__(self):
-        status_line = f"{self.http_version} {self.status_code} {self.reason}\r\n"
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.head = None
 
-        headers = "".join(
-            (f'"{key}": {value}\r\n' for key, value in self.headers.items())
-        )
-        return f"{status_line}{headers}\r\n{self.body}"
+    def status_line(self):
+        if self.http_version == DEFAULT_HTTP_VERSION and self.status_code in STATUS_LINES:
+            return STATUS_LINES[self.status_code]
+        return f"{self.http_version} {self.status_code} {self.reason}\r\n".encode("ascii")
 
+    def encode(self, keep_alive=True):
+        """
+        Returns the response as a list of byte strings for writelines.
+        Everything but the Date and the Connection header is encoded only once,
+        so a Response can be built at startup and sent many times.
+        """
+        if self.head is None:
+            self.head = b"".join([
+                self.status_line(),
+                b"" if "Server" in self.headers else b"Server: " + AsyncioHTTPHandler.banner + b"\r\n",
+                *[to_bytes(key) + b": " + to_bytes(value) + b"\r\n"
+                  for key, value in self.headers.items() if key != "Date"]
+            ])
+        return [self.head, refresh_date()[2], KEEP_ALIVE if keep_alive else CLOSE, self.body]
 
-def get_default_headers():
-    return OrderedDict({
-        "Date": format_date_time(None).encode("ascii"),
-        "Server": AsyncioHTTPHandler.banner
-    })
+    def __str__(self):
+        return b"".join(self.encode()).decode("latin-1")
 
 
-def response(headers=None, status_code=200, content_type="text/html", http_version=DEFAULT_HTTP_VERSION, body=""):
+def response(headers=None, status_code=200, content_type="text/html", http_version=DEFAULT_HTTP_VERSION, body=b""):
     if not headers:
-        headers = get_default_headers()
+        headers = {}
+    if isinstance(body, str):
+        body = body.encode("utf-8")
     headers.update({"Content-Type": content_type,
-                    "Content-Length": str(len(body))})
+                    "Content-Length": len(body)})
     return Response(status_code, headers, http_version, body)
 
 
@@ -140,18 +505,802 @@ def json(headers=None, status_code=200, content_type="application/json", http_ve
     return response(headers, status_code, content_type, http_version, dumps(body))
 
 
+class Route:
+
+    def __init__(self, method, path, handler):
+        self.method = method
+        self.path = path
+        self.handler = handler
+        self.metrics = None
+
+
+class RouteNode:
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.routes = {}
+        self.wildcard = {}
+
+
+class Router:
+    """
+    Routes without parameters are looked up in one dict per method.
+    Routes like /users/{id} live in a trie with one node per path segment, static segments are
+    preferred over parameters. A lookup costs one dict access per segment, however many routes exist.
+    A last segment like {name:path} matches the whole rest of the path.
+    """
+
+    def __init__(self):
+        self.static = defaultdict(dict)
+        self.root = RouteNode()
+
+    def add(self, method, path, handler):
+        route = Route(method, path, handler)
+        if "{" not in path:
+            self.static[method][path] = route
+            return route
+        node = self.root
+        names = []
+        for segment in path.strip("/").split("/"):
+            if segment.startswith("{") and segment.endswith(":path}"):
+                names.append(segment[1:-len(":path}")])
+                node.wildcard[method] = (route, names)
+                return route
+            if segment.startswith("{") and segment.endswith("}"):
+                names.append(segment[1:-1])
+                if node.param is None:
+                    node.param = RouteNode()
+                node = node.param
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        node.routes[method] = (route, names)
+        return route
+
+    def match(self, method, path):
+        route = self.static.get(method, {}).get(path)
+        if route:
+            return route, {}
+        return self._match(self.root, path.strip("/").split("/"), 0, method, [])
+
+    def _match(self, node, segments, i, method, values):
+        if i == len(segments):
+            found = node.routes.get(method)
+            if found:
+                route, names = found
+                return route, dict(zip(names, values))
+            return None, {}
+        child = node.children.get(segments[i])
+        if child:
+            route, params = self._match(child, segments, i + 1, method, values)
+            if route:
+                return route, params
+        if node.param and segments[i]:
+            values.append(unquote(segments[i]))
+            route, params = self._match(node.param, segments, i + 1, method, values)
+            if route:
+                return route, params
+            values.pop()
+        found = node.wildcard.get(method)
+        if found and segments[i]:
+            route, names = found
+            return route, dict(zip(names, [*values, unquote("/".join(segments[i:]))]))
+        return None, {}
+
+
+class FileResponse(Response):
+    """
+    A response whose body is count bytes of file starting at offset.
+    The body goes straight from the page cache to the socket with loop.sendfile, where the platform
+    or the transport does not support that it is sent in chunks read with os.pread.
+    """
+    streamed = True
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, status_code, headers, file, offset, count, http_version=DEFAULT_HTTP_VERSION):
+        super().__init__(status_code, headers, http_version)
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    async def send(self, transport, drain):
+        # loop.sendfile refuses a count of 0, an empty file has nothing to send anyway
+        if not self.count:
+            return 0
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.sendfile(transport, self.file, self.offset, self.count, fallback=False)
+        except asyncio.SendfileNotAvailableError:
+            pass
+        offset, end = self.offset, self.offset + self.count
+        while offset < end:
+            chunk = await loop.run_in_executor(None, os.pread, self.file.fileno(),
+                                               min(MAX_PAYLOAD_LEN, end - offset), offset)
+            if not chunk:
+                raise ConnectionError("File was truncated while sending it")
+            transport.write(chunk)
+            offset += len(chunk)
+            await drain()
+        return self.count
+
+
+class StreamingResponse(Response):
+    """
+    A response whose body is produced by an async iterator of bytes or str chunks.
+    Every chunk is written with chunked transfer encoding as soon as it is produced,
+    the iterator is only advanced once the transport has drained.
+    """
+    streamed = True
+    __slots__ = ("chunks",)
+
+    def __init__(self, status_code, headers, chunks, http_version=DEFAULT_HTTP_VERSION):
+        super().__init__(status_code, headers, http_version)
+        self.chunks = chunks
+
+    async def send(self, transport, drain):
+        sent = 0
+        try:
+            async for chunk in self.chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                # An empty chunk would end the body
+                if chunk:
+                    transport.writelines([b"%x\r\n" % len(chunk), chunk, b"\r\n"])
+                    sent += len(chunk)
+                    await drain()
+        except Exception:
+            # The status line is long gone, all we can do is to cut the response short
+            transport.close()
+            raise
+        transport.write(b"0\r\n\r\n")
+        return sent
+
+
+def stream(chunks, headers=None, status_code=200, content_type="text/plain; charset=utf-8",
+           http_version=DEFAULT_HTTP_VERSION):
+    if not headers:
+        headers = {}
+    headers.update({"Content-Type": content_type,
+                    "Transfer-Encoding": "chunked"})
+    return StreamingResponse(status_code, headers, chunks, http_version)
+
+
+def streamed(f):
+    async def handler(server, request):
+        return stream(f(server, request))
+
+    return handler
+
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_MESSAGE_LEN = 1024 * 1024
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+class WebSocketError(Exception):
+    __slots__ = ("code",)
+
+    def __init__(self, code):
+        self.code = code
+
+
+def encode_frame(opcode, payload=b""):
+    """
+    Frames sent by a server are never masked, so one encoded frame can be written to any number of clients.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    length = len(payload)
+    if length < 126:
+        header = bytes((0x80 | opcode, length))
+    elif length < 1 << 16:
+        header = bytes((0x80 | opcode, 126)) + length.to_bytes(2, "big")
+    else:
+        header = bytes((0x80 | opcode, 127)) + length.to_bytes(8, "big")
+    return header + payload
+
+
+def unmask(payload, mask):
+    # XOR the payload as one big integer instead of byte by byte in Python
+    length = len(payload)
+    if not length:
+        return payload
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+
+class WebSocket:
+    """
+    The server side of a WebSocket connection, frames are read from the body of the upgraded request.
+    Text messages are received as str and binary messages as bytes, receive returns None once the
+    connection is closed. Pings are answered while receiving.
+    """
+    __slots__ = ("request", "transport", "drain", "max_size", "sent", "closed", "close_code")
+
+    def __init__(self, request, max_size=MAX_MESSAGE_LEN):
+        self.request = request
+        self.transport = None
+        self.drain = None
+        self.max_size = max_size
+        self.sent = 0
+        self.closed = False
+        self.close_code = None
+
+    async def read_frame(self):
+        body = self.request.body
+        first, second = await body.readexactly(2)
+        fin, opcode, length = first & 0x80, first & 0x0F, second & 0x7F
+        # Extensions are never negotiated and every frame of a client has to be masked
+        if first & 0x70 or not second & 0x80:
+            raise WebSocketError(1002)
+        if opcode & 0x08 and (not fin or length > 125):
+            raise WebSocketError(1002)
+        if length == 126:
+            length = int.from_bytes(await body.readexactly(2), "big")
+        elif length == 127:
+            length = int.from_bytes(await body.readexactly(8), "big")
+        if length > self.max_size:
+            raise WebSocketError(1009)
+        mask = await body.readexactly(4)
+        return fin, opcode, unmask(await body.readexactly(length), mask)
+
+    async def receive(self):
+        fragments = []
+        size = 0
+        message_opcode = None
+        while not self.closed:
+            try:
+                fin, opcode, payload = await self.read_frame()
+            except WebSocketError as err:
+                await self.close(err.code)
+                return None
+            except (HTTPError, ConnectionError, asyncio.IncompleteReadError):
+                self.closed = True
+                self.close_code = 1006
+                return None
+            if opcode == OP_PING:
+                self.write(encode_frame(OP_PONG, payload))
+            elif opcode == OP_PONG:
+                pass
+            elif opcode == OP_CLOSE:
+                await self.close(int.from_bytes(payload[:2], "big") if len(payload) >= 2 else 1000)
+                return None
+            elif (opcode == OP_CONTINUATION) != (message_opcode is not None) or opcode not in (
+                    OP_CONTINUATION, OP_TEXT, OP_BINARY):
+                await self.close(1002)
+                return None
+            else:
+                message_opcode = message_opcode or opcode
+                size += len(payload)
+                if size > self.max_size:
+                    await self.close(1009)
+                    return None
+                fragments.append(payload)
+                if fin:
+                    message = fragments[0] if len(fragments) == 1 else b"".join(fragments)
+                    if message_opcode == OP_BINARY:
+                        return message
+                    try:
+                        return message.decode("utf-8")
+                    except UnicodeDecodeError:
+                        await self.close(1007)
+                        return None
+        return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def write(self, frame):
+        self.transport.write(frame)
+        self.sent += len(frame)
+
+    async def send(self, message):
+        if self.closed or self.transport.is_closing():
+            raise ConnectionResetError("WebSocket is closed")
+        self.write(encode_frame(OP_BINARY if isinstance(message, bytes) else OP_TEXT, message))
+        await self.drain()
+
+    async def close(self, code=1000, reason=""):
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        if not self.transport.is_closing():
+            self.write(encode_frame(OP_CLOSE, code.to_bytes(2, "big") + reason.encode("utf-8")))
+            try:
+                await self.drain()
+            except ConnectionError:
+                pass
+
+
+class WebSocketResponse(Response):
+    """
+    Switches the connection to the WebSocket protocol and runs handler(server, websocket) until it returns.
+    """
+    streamed = True
+    upgrade = True
+    __slots__ = ("server", "handler", "websocket")
+
+    def __init__(self, server, handler, websocket, accept, http_version=DEFAULT_HTTP_VERSION):
+        super().__init__(101, {"Upgrade": "websocket", "Sec-WebSocket-Accept": accept}, http_version)
+        self.server = server
+        self.handler = handler
+        self.websocket = websocket
+
+    def encode(self, keep_alive=True):
+        head, date, _, body = super().encode(keep_alive)
+        return [head, date, UPGRADE, body]
+
+    async def send(self, transport, drain):
+        websocket = self.websocket
+        # The 101 is out, a session lasts as long as the client likes and does not count against max_requests
+        self.server.finished(websocket.request)
+        websocket.transport = transport
+        websocket.drain = drain
+        try:
+            await self.handler(self.server, websocket)
+        except ConnectionError:
+            websocket.closed = True
+        except Exception:
+            await websocket.close(1011)
+            transport.close()
+            raise
+        await websocket.close()
+        return websocket.sent
+
+
+def accept_websocket(f, max_size=MAX_MESSAGE_LEN):
+    async def handler(server, request):
+        headers = request.headers
+        key = headers.get(b"sec-websocket-key")
+        if (not key or headers.get(b"upgrade", b"").lower() != b"websocket"
+                or b"upgrade" not in headers.get(b"connection", b"").lower()):
+            raise HTTPError(400)
+        if headers.get(b"sec-websocket-version") != b"13":
+            return json({"Sec-WebSocket-Version": 13}, status_code=426)
+        accept = b64encode(sha1(key + WEBSOCKET_GUID).digest()).decode("ascii")
+        return WebSocketResponse(server, f, WebSocket(request, max_size), accept)
+
+    return handler
+
+
+class Broadcast:
+    """
+    Sends every published message to all subscribed websockets.
+    The frame is encoded once and the very same bytes are written to every transport. A subscriber whose
+    write buffer is above high_water is disconnected, or with disconnect=False misses the message,
+    so one slow client neither stalls the others nor makes the server buffer without bound.
+    """
+
+    def __init__(self, high_water=256 * 1024, disconnect=True):
+        self.subscribers = set()
+        self.high_water = high_water
+        self.disconnect = disconnect
+        self.dropped = 0
+
+    def subscribe(self, websocket):
+        self.subscribers.add(websocket)
+
+    def unsubscribe(self, websocket):
+        self.subscribers.discard(websocket)
+
+    def publish(self, message):
+        """
+        Returns the number of subscribers the message was written to.
+        """
+        frame = encode_frame(OP_BINARY if isinstance(message, bytes) else OP_TEXT, message)
+        delivered = 0
+        for websocket in list(self.subscribers):
+            transport = websocket.transport
+            if websocket.closed or transport.is_closing():
+                self.subscribers.discard(websocket)
+            elif transport.get_write_buffer_size() > self.high_water:
+                self.dropped += 1
+                if self.disconnect:
+                    self.subscribers.discard(websocket)
+                    transport.abort()
+            else:
+                websocket.write(frame)
+                delivered += 1
+        return delivered
+
+
+class StaticFiles:
+    """
+    Serves the files below directory, answers Range and If-Modified-Since requests.
+    Up to cache_size files are kept open, a file that changed on disk is opened again.
+    """
+
+    def __init__(self, directory, cache_size=256):
+        self.directory = os.path.realpath(directory)
+        self.cache_size = cache_size
+        self.files = OrderedDict()
+
+    def open(self, path):
+        stat = os.stat(path)
+        if not S_ISREG(stat.st_mode):
+            raise HTTPError(404)
+        cached = self.files.get(path)
+        if cached and cached[1].st_ino == stat.st_ino and cached[1].st_mtime_ns == stat.st_mtime_ns:
+            self.files.move_to_end(path)
+            return cached
+        # Evicted files are not closed explicitly, a response that is still sending one holds a reference to it
+        cached = self.files[path] = (open(path, "rb"), stat)
+        self.files.move_to_end(path)
+        while len(self.files) > self.cache_size:
+            self.files.popitem(last=False)
+        return cached
+
+    async def __call__(self, server, request):
+        try:
+            path = os.path.realpath(os.path.join(self.directory, request.params["path"]))
+        except ValueError:
+            # An embedded null byte
+            raise HTTPError(404)
+        if not path.startswith(self.directory + os.sep):
+            raise HTTPError(404)
+        try:
+            file, stat = self.open(path)
+        except (OSError, ValueError):
+            raise HTTPError(404)
+
+        last_modified = format_date_time(stat.st_mtime)
+        headers = {
+            "Content-Type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+            "Last-Modified": last_modified,
+            "Accept-Ranges": "bytes",
+        }
+        if_modified_since = request.headers.get(b"if-modified-since")
+        if if_modified_since:
+            since = parsedate_tz(if_modified_since.decode("latin-1"))
+            if since and int(stat.st_mtime) <= mktime_tz(since):
+                return Response(304, headers)
+
+        size = stat.st_size
+        byte_range = parse_range(request.headers.get(b"range"), size)
+        if byte_range is None:
+            headers["Content-Length"] = size
+            return FileResponse(200, headers, file, 0, size)
+        if byte_range is False:
+            return Response(416, {"Content-Range": f"bytes */{size}", "Content-Length": 0})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = end - start + 1
+        return FileResponse(206, headers, file, start, end - start + 1)
+
+
+def parse_range(header, size):
+    """
+    Returns the first and last byte of a single range, None to send the whole file
+    and False if the range can not be satisfied.
+    """
+    if not header or not header.startswith(b"bytes=") or b"," in header:
+        return None
+    start, _, end = header[len(b"bytes="):].strip().partition(b"-")
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix < 0:
+                return None
+            if suffix == 0 or size == 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start < 0:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class CachedResponse:
+
+    def __init__(self, response, not_modified, etag, expires):
+        self.response = response
+        self.not_modified = not_modified
+        self.etag = etag
+        self.expires = expires
+
+
+class ResponseCache:
+    """
+    Bounded LRU of responses, every entry expires ttl seconds after it was stored.
+    The responses are kept with their head already encoded, so a hit costs no serialization at all.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry.expires < monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, response, ttl):
+        etag = '"' + blake2b(response.body, digest_size=16).hexdigest() + '"'
+        response.headers["ETag"] = etag
+        response.encode()
+        not_modified = Response(304, {"ETag": etag})
+        not_modified.encode()
+        entry = self.entries[key] = CachedResponse(response, not_modified, etag, monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def stats(self):
+        return dict(size=len(self.entries), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+def matches_etag(request, etag):
+    if_none_match = request.headers.get(b"if-none-match")
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix(b"W/") for candidate in if_none_match.split(b",")}
+    return b"*" in candidates or etag.encode("ascii") in candidates
+
+
+def cached(f, ttl):
+    async def handler(server, request):
+        key = (request.method, request.url)
+        entry = server.cache.get(key)
+        if entry is None:
+            resp = await f(server, request)
+            if resp.status_code != 200 or resp.streamed:
+                return resp
+            entry = server.cache.put(key, resp, ttl)
+        if matches_etag(request, entry.etag):
+            return entry.not_modified
+        return entry.response
+
+    return handler
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, its memory does not grow with the number of observations.
+    """
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class RouteMetrics:
+
+    def __init__(self, method, route):
+        self.method = method
+        self.route = route
+        self.latency = Histogram()
+        self.statuses = defaultdict(int)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.parse_seconds = 0.0
+        self.handler_seconds = 0.0
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Per route and method metrics, recording a response costs a handful of additions and one bisect.
+    Requests that did not match a route are recorded with the route label "unmatched".
+    """
+
+    def __init__(self):
+        self.routes = []
+        self.unmatched = {}
+
+    def register(self, route):
+        route.metrics = RouteMetrics(route.method, route.path)
+        self.routes.append(route.metrics)
+
+    def observe(self, request, status_code, sent):
+        if request.route:
+            metrics = request.route.metrics
+        else:
+            method = request.method.decode("latin-1")
+            metrics = self.unmatched.get(method)
+            if metrics is None:
+                metrics = self.unmatched[method] = RouteMetrics(method, "unmatched")
+                self.routes.append(metrics)
+        metrics.latency.observe(perf_counter() - request.started)
+        metrics.statuses[status_code] += 1
+        metrics.bytes_in += request.body.received
+        metrics.bytes_out += sent
+        metrics.parse_seconds += request.parse_seconds
+        metrics.handler_seconds += request.handler_seconds
+
+    def render(self, server):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP http_request_duration_seconds Time from the end of the request headers until the response was sent.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for metrics in self.routes:
+            labels = f'method="{escape_label(metrics.method)}",route="{escape_label(metrics.route)}"'
+            cumulative = 0
+            for bound, count in zip((*Histogram.buckets, "+Inf"), metrics.latency.counts):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {metrics.latency.sum}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {cumulative}")
+
+        counters = [
+            ("http_request_bytes_total", "Bytes of request bodies received.", "bytes_in"),
+            ("http_response_bytes_total", "Bytes of responses sent.", "bytes_out"),
+            ("http_parse_seconds_total", "Seconds spent receiving and parsing request headers.", "parse_seconds"),
+            ("http_handler_seconds_total", "Seconds spent in route handlers, including the bodies of streamed "
+                                           "responses but not WebSocket sessions.", "handler_seconds"),
+        ]
+        for name, description, attribute in counters:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for metrics in self.routes:
+                labels = f'method="{escape_label(metrics.method)}",route="{escape_label(metrics.route)}"'
+                lines.append(f"{name}{{{labels}}} {getattr(metrics, attribute)}")
+
+        lines.append("# HELP http_responses_total Responses sent by status code.")
+        lines.append("# TYPE http_responses_total counter")
+        for metrics in self.routes:
+            labels = f'method="{escape_label(metrics.method)}",route="{escape_label(metrics.route)}"'
+            for status_code, count in sorted(metrics.statuses.items()):
+                lines.append(f'http_responses_total{{{labels},status="{status_code}"}} {count}')
+
+        gauges = [("http_connections", "Open connections.", len(server.connections)),
+                  ("http_requests_in_flight", "Requests being handled.", server.in_flight)]
+        for name, description, value in gauges:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"]
+        totals = [("http_shed_connections_total", "Connections refused with 503.", server.shed_connections),
+                  ("http_shed_requests_total", "Requests refused with 503.", server.shed_requests),
+                  ("http_cancelled_requests_total", "Requests cancelled because the client went away.",
+                   server.cancelled_requests),
+                  ("http_cache_hits_total", "Response cache hits.", server.cache.hits),
+                  ("http_cache_misses_total", "Response cache misses.", server.cache.misses),
+                  ("http_cache_evictions_total", "Response cache evictions.", server.cache.evictions)]
+        for name, description, value in totals:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} counter", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+# The monotonic() time by which the request that is being handled has to be answered
+request_deadline = ContextVar("request_deadline", default=None)
+
+
+def remaining():
+    """
+    Seconds left until the deadline of the current request, None outside of a request.
+    """
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - monotonic()
+
+
+async def within_deadline(aw):
+    """
+    Awaits aw, but raises HTTPError(504) once the deadline of the current request has passed,
+    e.g. rows = await within_deadline(database.fetch(query)).
+    """
+    timeout = remaining()
+    if timeout is None:
+        return await aw
+    if timeout <= 0:
+        if inspect.iscoroutine(aw):
+            aw.close()
+        raise HTTPError(504)
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise HTTPError(504)
+
+
+def takes_request(f):
+    return len(inspect.signature(f).parameters) > 1
+
+
+def ignore_request(f):
+    def handler(server, request):
+        return f(server)
+
+    return handler
+
+
 class AsyncioHTTPHandler:
-    allowed_methods = ["GET"]
+    allowed_methods = ["GET", "POST", "PUT"]
     version = 1.0
     banner = f"AsyncioHTTPServer/{version}".encode("ascii")
     default_timeout = 30
+    default_keep_alive_timeout = 5
+    default_request_timeout = 30
+    default_head_timeout = 10
+    default_backlog = 100
 
-    def __init__(self, host, timeout=default_timeout):
+    def __init__(self, host, timeout=default_timeout, keep_alive_timeout=default_keep_alive_timeout,
+                 cache_size=1024, max_connections=None, max_requests=None, retry_after=1,
+                 backlog=default_backlog, record_metrics=True, request_timeout=default_request_timeout,
+                 cancel_on_disconnect=True, head_timeout=default_head_timeout, allow_half_close=False):
         self.host = host
-        self.routes = defaultdict(dict)
+        self.routes = Router()
+        self.cache = ResponseCache(cache_size)
+        self.metrics = Metrics()
+        self.record_metrics = record_metrics
         self.timeout = timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        # Every request gets request_timeout seconds from the moment its handler starts, see within_deadline
+        self.request_timeout = request_timeout
+        # The request line and the headers have to arrive within head_timeout seconds, while timeout is per read
+        self.head_timeout = head_timeout
+        # Handlers of a client that went away are cancelled instead of answering nobody. With allow_half_close
+        # a client that closes its side after sending its requests still gets the answers, only a reset or a
+        # failed write cancels then
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self.allow_half_close = allow_half_close
+        self.cancelled_requests = 0
+        self.connections = set()
+        self.draining = False
+        # Admission control, None means unlimited
+        self.max_connections = max_connections
+        self.max_requests = max_requests
+        self.backlog = backlog
+        self.in_flight = 0
+        self.shed_connections = 0
+        self.shed_requests = 0
+        # Error responses never change, so they are built once instead of on every error
+        self.error_responses = {
+            status_code: json(status_code=status_code) for status_code in REASONS if status_code >= 400
+        }
+        self.error_responses[404] = response(status_code=404, body=NOT_FOUND)
+        self.error_responses[405] = json({"Allow": ", ".join(AsyncioHTTPHandler.allowed_methods)}, status_code=405)
+        self.error_responses[503] = json({"Retry-After": retry_after}, status_code=503)
 
-    def route(self, *args, method="GET", path=None):
+    def admit_connection(self):
+        if self.max_connections is not None and len(self.connections) >= self.max_connections:
+            self.shed_connections += 1
+            return False
+        return True
+
+    def admission_stats(self):
+        return dict(connections=len(self.connections), in_flight=self.in_flight,
+                    shed_connections=self.shed_connections, shed_requests=self.shed_requests,
+                    cancelled_requests=self.cancelled_requests)
+
+    def route(self, *args, method="GET", path=None, cache=None):
+        """
+        Registers a handler for method and path.
+        With cache set to a number of seconds the encoded response is kept in the response cache for that long,
+        requests carrying a matching If-None-Match header are answered with 304 without running the handler.
+        Async generator handlers are streamed with chunked transfer encoding, return stream(...) from a
+        regular handler to pick the status code and headers of a streamed response.
+        """
 
         def register_me(f):
             nonlocal path, self
@@ -164,7 +1313,12 @@ class AsyncioHTTPHandler:
 
             if not path.startswith("/"):
                 path = urljoin("/", path)
-            self.routes[http_method][path] = f
+            handler = f if takes_request(f) else ignore_request(f)
+            if inspect.isasyncgenfunction(f):
+                handler = streamed(handler)
+            if cache:
+                handler = cached(handler, cache)
+            self.metrics.register(self.routes.add(http_method, path, handler))
             return f
 
         if args:
@@ -173,48 +1327,437 @@ class AsyncioHTTPHandler:
         return register_me
 
     async def on_connection(self, reader, writer):
+        if not self.admit_connection():
+            writer.writelines(self.error_responses[503].encode(False))
+            writer.close()
+            return
+        proto = HTTPProtocol(MAX_PAYLOAD_LEN, self.head_timeout)
+        proto.transport = writer.transport
+        self.connections.add(proto)
+        reading = asyncio.ensure_future(self.read_requests(reader, proto, asyncio.current_task()))
         try:
-            request = await asyncio.wait_for(reader.read(MAX_PAYLOAD_LEN), self.timeout)
-            await self.send(writer, await self.handle(request))
-        except HTTPError as err:
-            if err.status_code == 404:
-                await self.send(writer, response(status_code=err.status_code, body=NOT_FOUND))
-            elif err.status_code == 405:
-                headers = get_default_headers()
-                headers.update(Allow=", ".join(AsyncioHTTPHandler.allowed_methods))
-                await self.send(writer, json(headers, status_code=err.status_code))
-            else:
-                await self.send(writer, json(status_code=err.status_code))
-        except TimeoutError:
-            await self.send(writer, json(status_code=408))
+            # Pipelined requests are answered one after another in the order they arrived
+            while True:
+                request = await proto.next_request()
+                if not request:
+                    break
+                try:
+                    resp = await self.handle(request)
+                except HTTPError as err:
+                    resp = self.error_response(err.status_code)
+                except Exception:
+                    # One broken handler does not take the requests pipelined behind it down
+                    logging.exception("Handler of %s failed", request.url)
+                    resp = self.error_response(500)
+                # Whatever the handler did not read is thrown away so the next request can be parsed
+                if not resp.upgrade:
+                    request.body.discard()
+                keep_alive = request.keep_alive and not self.draining
+                try:
+                    sent = await self.send(writer, resp, keep_alive=keep_alive)
+                finally:
+                    self.finished(request)
+                self.observe(request, resp, sent)
+                proto.pending -= 1
+                if not keep_alive:
+                    return
+
+            error = await reading
+            if error:
+                await self.send(writer, self.error_response(error.status_code), keep_alive=False)
+        except ConnectionError:
+            pass
+        except Exception:
+            # The status line is already out when the body of a streamed response fails, all we can do is hang up
+            logging.exception("Failed to send the response")
+        except asyncio.CancelledError:
+            # read_requests cancels us when the client went away, anything else is a real cancellation
+            if not proto.finished:
+                raise
         finally:
+            self.connections.discard(proto)
+            reading.cancel()
             writer.close()
 
-    async def handle(self, request):
-        finish_parsing = asyncio.get_running_loop().create_future()
-        proto = HTTPProtocol(future=finish_parsing)
+    async def drain(self, grace_period):
+        """
+        Closes idle connections right away and lets the busy ones finish their current request.
+        Connections still open after grace_period seconds are closed regardless.
+        """
+        self.draining = True
+        deadline = time() + grace_period
+        while self.connections and time() < deadline:
+            for proto in list(self.connections):
+                if proto.idle():
+                    proto.transport.close()
+            await asyncio.sleep(0.1)
+        for proto in list(self.connections):
+            proto.transport.close()
 
-        # Ignore upgrade requests for now
-        proto.feed_data(request)
-        await finish_parsing
+    async def read_requests(self, reader, proto, connection):
+        error = None
+        disconnected = False
+        try:
+            while True:
+                # Between two requests we only wait for the keep alive timeout
+                idle = proto.received and not proto.in_progress
+                timeout = self.keep_alive_timeout if idle else self.timeout
+                if proto.head_deadline is not None and not proto.pending:
+                    # Trickling the head in byte by byte does not buy a fresh timeout with every read
+                    timeout = min(timeout, proto.head_deadline - monotonic())
+                try:
+                    data = await asyncio.wait_for(reader.read(MAX_PAYLOAD_LEN), timeout)
+                except asyncio.TimeoutError:
+                    if proto.pending:
+                        # The client is allowed to be quiet while we are answering
+                        continue
+                    if not idle or proto.head_deadline is not None:
+                        error = HTTPError(408)
+                    break
+                if not data:
+                    # Requests queued behind the one being handled look like a client that half-closed after
+                    # sending them all, otherwise it gave up
+                    disconnected = not self.allow_half_close and not proto.requests
+                    break
+                proto.feed_data(data)
+                await proto.drain()
+        except HTTPError as err:
+            error = err
+        except HttpParserError:
+            error = HTTPError(400)
+        except ConnectionError:
+            disconnected = True
+        if disconnected and proto.pending and not proto.upgraded and self.cancel_on_disconnect:
+            # Nobody is left to read the answer, so stop working on it
+            self.cancelled_requests += 1
+            connection.cancel()
+        return proto.finish(error)
 
+    def error_response(self, status_code):
+        if status_code not in self.error_responses:
+            return json(status_code=status_code)
+        return self.error_responses[status_code]
+
+    async def handle(self, request):
         try:
-            path = proto.url.decode("UTF-8")
-            method = proto.parser.get_method().decode("UTF-8")
+            path, _, query = request.url.decode("UTF-8").partition("?")
+            method = request.method.decode("UTF-8")
         except UnicodeDecodeError:
             raise HTTPError(500)
 
         if not method.upper() in AsyncioHTTPHandler.allowed_methods:
             raise HTTPError(405)
 
-        handler = self.routes[method].get(path)
-        if not handler:
+        request.path = path
+        request.query = query
+        route, request.params = self.routes.match(method, path)
+        if not route:
             raise HTTPError(404)
-        return await handler(self)
+        request.route = route
+        if self.max_requests is not None and self.in_flight >= self.max_requests:
+            # Shedding a request right away is cheaper for everyone than queueing it
+            self.shed_requests += 1
+            return self.error_responses[503]
+        self.in_flight += 1
+        request.handler_started = perf_counter()
+        # Set before the first await, so the task that might continue the handler copies it
+        request_deadline.set(monotonic() + self.request_timeout)
+        streamed = False
+        try:
+            resp = await route.handler(self, request)
+            streamed = resp.streamed
+            return resp
+        finally:
+            # The body of a streamed response is produced while it is sent, the request is finished after that
+            if not streamed:
+                self.finished(request)
 
-    async def send(self, writer, response):
-        writer.write(str(response).encode("ascii"))
+    def finished(self, request):
+        """
+        Stops counting the request as in flight, it is fine to call this more than once.
+        """
+        if request.handler_started is not None:
+            self.in_flight -= 1
+            request.handler_seconds = perf_counter() - request.handler_started
+            request.handler_started = None
+
+    def websocket(self, *args, path=None, max_size=MAX_MESSAGE_LEN):
+        """
+        Registers handler(server, websocket) for WebSocket connections to path,
+        the handler runs for as long as the connection stays open.
+        """
+
+        def register_me(f):
+            self.route(path=path or f.__name__)(accept_websocket(f, max_size))
+            return f
+
+        if args:
+            f, = args
+            return register_me(f)
+        return register_me
+
+    def static(self, prefix, directory, cache_size=256):
+        """
+        Serves the files below directory under prefix, e.g. static("/static", "assets").
+        """
+        self.route(path=prefix.rstrip("/") + "/{path:path}")(StaticFiles(directory, cache_size))
+
+    def expose_metrics(self, path="/metrics"):
+        async def metrics(server):
+            return response(content_type="text/plain; version=0.0.4", body=server.metrics.render(server))
+
+        self.route(path=path)(metrics)
+
+    def observe(self, request, response, sent):
+        if self.record_metrics:
+            self.metrics.observe(request, response.status_code, sent)
+
+    async def send(self, writer, response, keep_alive=True):
+        """
+        Returns the number of bytes sent.
+        """
+        chunks = response.encode(keep_alive)
+        writer.writelines(chunks)
+        sent = sum(map(len, chunks))
+        if response.streamed:
+            sent += await response.send(writer.transport, writer.drain)
         await writer.drain()
+        return sent
+
+
+def start_task(loop, coro):
+    """
+    Runs the coroutine in a task. From Python 3.12 on the task starts eagerly, a coroutine that does not
+    actually await anything is done when this returns and never goes through the event loop.
+    """
+    if EAGER_TASKS:
+        return asyncio.Task(coro, loop=loop, eager_start=True)
+    return loop.create_task(coro)
+
+
+class HTTPServerProtocol(asyncio.Protocol):
+    """
+    Serves the routes of an AsyncioHTTPHandler straight from data_received.
+    Every handler runs in a task of its own, see start_task, a handler that returns right away is answered
+    without a StreamReader/StreamWriter pair.
+    """
+    __slots__ = ("handler", "loop", "transport", "proto", "task", "timer", "writing_paused", "drain_waiter")
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.proto = None
+        self.task = None
+        self.timer = None
+        self.writing_paused = False
+        self.drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.handler.admit_connection():
+            transport.writelines(self.handler.error_responses[503].encode(False))
+            transport.close()
+            return
+        self.proto = HTTPProtocol(MAX_PAYLOAD_LEN, self.handler.head_timeout)
+        self.proto.transport = transport
+        self.handler.connections.add(self.proto)
+        self.reset_timer()
+
+    def data_received(self, data):
+        try:
+            self.proto.feed_data(data)
+        except HTTPError as err:
+            self.fail(err)
+            return
+        except HttpParserError:
+            self.fail(HTTPError(400))
+            return
+        request = self.proto.request
+        if request is not None and request.body.full():
+            self.pause_reading(request.body)
+        if self.proto.unparsed is not None and self.proto.queue_waiter is None:
+            self.hold_back()
+        self.process_requests()
+        self.reset_timer()
+
+    def eof_received(self):
+        # Like read_requests, with allow_half_close or queued requests the transport stays open for the answers
+        # and is closed once they are sent
+        if not self.handler.allow_half_close and not self.proto.requests and self.abandon():
+            self.proto.finish()
+            self.transport.close()
+        else:
+            self.fail()
+        return True
+
+    def connection_lost(self, exc):
+        if self.proto is None:
+            return
+        self.abandon()
+        if self.timer:
+            self.timer.cancel()
+        self.handler.connections.discard(self.proto)
+        self.proto.finish()
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_exception(ConnectionResetError("Connection lost"))
+
+    def pause_writing(self):
+        self.writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        if self.reading_allowed():
+            self.transport.resume_reading()
+
+    async def drain(self):
+        if self.writing_paused:
+            self.drain_waiter = self.loop.create_future()
+            try:
+                await self.drain_waiter
+            finally:
+                self.drain_waiter = None
+
+    def pause_reading(self, body):
+        self.transport.pause_reading()
+        body.writer_waiter = self.loop.create_future()
+        body.writer_waiter.add_done_callback(lambda _: self.resume_reading(body))
+
+    def resume_reading(self, body):
+        body.writer_waiter = None
+        if body.full():
+            self.pause_reading(body)
+        elif self.reading_allowed():
+            self.transport.resume_reading()
+
+    def hold_back(self):
+        # Too many requests wait to be handled, the rest of the data is parsed once one of them is popped
+        self.transport.pause_reading()
+        self.proto.queue_waiter = self.loop.create_future()
+        self.proto.queue_waiter.add_done_callback(lambda _: self.resume_parsing())
+
+    def resume_parsing(self):
+        self.proto.queue_waiter = None
+        if self.transport.is_closing():
+            return
+        data, self.proto.unparsed = self.proto.unparsed, None
+        self.data_received(data)
+        if self.reading_allowed():
+            self.transport.resume_reading()
+
+    def reading_allowed(self):
+        request = self.proto.request
+        return (not self.writing_paused and self.proto.unparsed is None and not self.transport.is_closing()
+                and (request is None or not request.body.full()))
+
+    def abandon(self):
+        """
+        Cancels the task of the request being handled when the client went away.
+        Returns whether there was one.
+        """
+        if self.task is None or self.proto.upgraded or not self.handler.cancel_on_disconnect:
+            return False
+        self.handler.cancelled_requests += 1
+        self.task.cancel()
+        self.task = None
+        return True
+
+    def reset_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.proto.pending:
+            return
+        head_deadline = self.proto.head_deadline
+        if head_deadline is not None:
+            # Trickling the head in byte by byte does not buy a fresh timeout with every read
+            timeout = min(self.handler.timeout, head_deadline - monotonic())
+            self.timer = self.loop.call_later(max(timeout, 0), self.fail, HTTPError(408))
+        elif self.proto.received and not self.proto.in_progress:
+            self.timer = self.loop.call_later(self.handler.keep_alive_timeout, self.fail)
+        else:
+            self.timer = self.loop.call_later(self.handler.timeout, self.fail, HTTPError(408))
+
+    def fail(self, error=None):
+        error = self.proto.finish(error)
+        if self.proto.pending:
+            # Let the handlers in flight answer before the connection is closed
+            return
+        if error:
+            self.transport.writelines(self.handler.error_response(error.status_code).encode(False))
+        self.transport.close()
+
+    def process_requests(self):
+        while self.task is None and self.proto.requests and not self.transport.is_closing():
+            request = self.proto.pop_request()
+            task = start_task(self.loop, self.handle(request))
+            if task.done():
+                self.respond(request, task.result())
+            else:
+                self.task = task
+                task.add_done_callback(lambda task, request=request: self.handled(request, task))
+
+    async def handle(self, request):
+        try:
+            return await self.handler.handle(request)
+        except HTTPError as err:
+            return self.handler.error_response(err.status_code)
+        except Exception:
+            logging.exception("Handler of %s failed", request.url)
+            return self.handler.error_response(500)
+
+    def handled(self, request, task):
+        if task.cancelled():
+            # Abandoned, the client is gone
+            return
+        self.task = None
+        self.respond(request, task.result())
+        self.process_requests()
+
+    def respond(self, request, response):
+        if not response.upgrade:
+            request.body.discard()
+        if self.transport.is_closing():
+            self.handler.finished(request)
+            self.proto.pending -= 1
+            return
+        keep_alive = request.keep_alive and not self.handler.draining
+        chunks = response.encode(keep_alive)
+        self.transport.writelines(chunks)
+        sent = sum(map(len, chunks))
+        if response.streamed:
+            self.task = self.loop.create_task(self.send_body(request, response, keep_alive, sent))
+        else:
+            self.handler.observe(request, response, sent)
+            self.responded(keep_alive)
+
+    async def send_body(self, request, response, keep_alive, sent):
+        try:
+            sent += await response.send(self.transport, self.drain)
+        except ConnectionError:
+            keep_alive = False
+        except Exception:
+            # The status line is already out, all we can do is hang up
+            logging.exception("Failed to send the body of %s", request.url)
+            keep_alive = False
+        finally:
+            self.task = None
+            self.handler.finished(request)
+        self.handler.observe(request, response, sent)
+        self.responded(keep_alive)
+        self.process_requests()
+
+    def responded(self, keep_alive):
+        self.proto.pending -= 1
+        if not keep_alive:
+            self.transport.close()
+        elif self.proto.finished and not self.proto.pending and not self.proto.requests:
+            self.transport.close()
+        else:
+            self.reset_timer()
 
 
 host = "127.0.0.1"
@@ -228,13 +1771,180 @@ async def test_me(server):
     return json(body=dict(it_works=True))
 
 
-async def main():
-    s = await asyncio.start_server(server.on_connection, host, port)
+@server.route(path="/users/{id}")
+async def user(server, request):
+    return json(body=dict(id=request.params["id"], **request.query_args()))
+
+
+@server.route()
+async def slow(server):
+    await within_deadline(asyncio.sleep(0.1))
+    return json(body=dict(slept=0.1))
+
+
+@server.route(cache=10)
+async def report(server):
+    await asyncio.sleep(0.1)
+    return json(body=dict(rows=list(range(100))))
+
+
+@server.route()
+async def export(server):
+    for i in range(10000):
+        yield dumps(dict(id=i)) + "\n"
+
+
+server.static("/static", os.path.dirname(os.path.abspath(__file__)))
+server.expose_metrics()
+
+
+@server.route(method="POST")
+async def upload(server, request):
+    size = 0
+    async for chunk in request.body:
+        size += len(chunk)
+    return json(body=dict(received=size))
+
+
+chat = Broadcast()
+
+
+@server.websocket
+async def live(server, websocket):
+    chat.subscribe(websocket)
+    try:
+        async for message in websocket:
+            chat.publish(message)
+    finally:
+        chat.unsubscribe(websocket)
+
+
+processes = []
+default_grace_period = 10
+
+
+async def main(host=host, port=port, protocol=False, reuse_port=None, grace_period=default_grace_period):
+    loop = asyncio.get_running_loop()
+    if protocol:
+        s = await loop.create_server(lambda: HTTPServerProtocol(server), host, port, reuse_port=reuse_port,
+                                     backlog=server.backlog)
+    else:
+        s = await asyncio.start_server(server.on_connection, host, port, reuse_port=reuse_port,
+                                       backlog=server.backlog)
+
+    stopping = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, lambda: stopping.done() or stopping.set_result(None))
+        except NotImplementedError:
+            # Signal handlers are not supported by the windows event loops
+            pass
     async with s:
-        await s.serve_forever()
+        await stopping
+        s.close()
+        await server.drain(grace_period)
 
-if __name__ == '__main__':
+
+def configure(settings):
+    for name, value in settings.items():
+        setattr(server, name, value)
+
+
+def process_main(host, port, protocol, grace_period, settings):
+    """
+    This is the main method of a worker process.
+    Like in chapter_02/sol_04_option_2.py every process runs its own event loop, SO_REUSEPORT lets the
+    kernel spread the incoming connections over the sockets of all the workers.
+    :param host:
+    :param port:
+    :param protocol:
+    :param grace_period:
+    :param settings: attributes of the AsyncioHTTPHandler to set in the worker
+    :return:
+    """
+    configure(settings)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("Closed..")
+        loop.run_until_complete(main(host, port, protocol, reuse_port=True, grace_period=grace_period))
+    finally:
+        loop.close()
+
+
+def cleanup():
+    global processes
+    while processes:
+        proc = processes.pop()
+        proc.join()
+
+
+def spawn_worker(*args):
+    proc = Process(target=process_main, args=args)
+    proc.start()
+    proc.started = time()
+    return proc
+
+
+def supervise(number_of_workers, host, port, protocol, grace_period, settings):
+    """
+    Forks the workers and restarts the ones that die.
+    SIGINT and SIGTERM are forwarded to the workers, which drain their connections before they exit.
+    """
+    global processes
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for proc in processes:
+            if proc.is_alive():
+                proc.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    args = (host, port, protocol, grace_period, settings)
+    processes = [spawn_worker(*args) for _ in range(number_of_workers)]
+    while not stopping:
+        wait([proc.sentinel for proc in processes], timeout=1)
+        for i, proc in enumerate(processes):
+            if proc.is_alive() or stopping:
+                continue
+            print(f"Worker {proc.pid} exited with {proc.exitcode}, restarting it..")
+            if time() - proc.started < 1:
+                # Do not restart a worker that keeps crashing on startup in a tight loop
+                sleep(1)
+            processes[i] = spawn_worker(*args)
+    cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=host)
+    parser.add_argument("--port", type=int, default=port)
+    parser.add_argument("--protocol", action="store_true", help="Use the asyncio.Protocol based server")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes that share the port via SO_REUSEPORT")
+    parser.add_argument("--grace-period", type=float, default=default_grace_period,
+                        help="Seconds to let open connections finish on shutdown")
+    parser.add_argument("--max-connections", type=int, help="Connections over this limit are answered with 503")
+    parser.add_argument("--max-requests", type=int,
+                        help="Requests over this number of requests in flight are answered with 503")
+    parser.add_argument("--backlog", type=int, default=AsyncioHTTPHandler.default_backlog,
+                        help="Length of the accept queue")
+    parser.add_argument("--request-timeout", type=float, default=AsyncioHTTPHandler.default_request_timeout,
+                        help="Seconds a handler has before awaits made with within_deadline fail with 504")
+    parser.add_argument("--head-timeout", type=float, default=AsyncioHTTPHandler.default_head_timeout,
+                        help="Seconds a client has to send the request line and the headers before it gets a 408")
+    parser.add_argument("--allow-half-close", action="store_true",
+                        help="Answer clients that close their side of the connection after sending their requests")
+    args = parser.parse_args()
+    settings = dict(max_connections=args.max_connections, max_requests=args.max_requests, backlog=args.backlog,
+                    request_timeout=args.request_timeout, head_timeout=args.head_timeout,
+                    allow_half_close=args.allow_half_close)
+    if args.workers > 1:
+        supervise(args.workers, args.host, args.port, args.protocol, args.grace_period, settings)
+    else:
+        configure(settings)
+        asyncio.run(main(args.host, args.port, args.protocol, grace_period=args.grace_period))
+    print("Closed..")
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+from collections import Counter
+from multiprocessing import get_context
+
+from chapter_09 import sol_03
+
+REQUEST = "GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: {connection}\r\n\r\n"
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+
+    def record(self, status_code, latency):
+        self.statuses[status_code] += 1
+        if status_code >= 400:
+            self.errors[f"HTTP {status_code}"] += 1
+        self.latencies.append(latency)
+
+    def error(self, exc):
+        self.errors[type(exc).__name__] += 1
+
+    def percentiles(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        result = {f"p{percentile:g}": latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+                  for percentile in PERCENTILES}
+        result["max"] = latencies[-1]
+        return {key: round(value * 1000, 3) for key, value in result.items()}
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, *lines = head[:-4].split(b"\r\n")
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get(b"transfer-encoding") == b"chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n"))[:-2], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get(b"content-length", 0)))
+    return int(status_line.split(b" ")[1])
+
+
+async def close_per_request(host, port, path, deadline, pipeline, timeout, stats):
+    request = REQUEST.format(host=host, path=path, connection="close").encode("ascii")
+    while time.monotonic() < deadline:
+        writer = None
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            writer.write(request)
+            status_code = await asyncio.wait_for(read_response(reader), timeout)
+            stats.record(status_code, time.perf_counter() - start)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as exc:
+            stats.error(exc)
+        finally:
+            if writer:
+                writer.close()
+
+
+async def keep_alive(host, port, path, deadline, pipeline, timeout, stats):
+    request = REQUEST.format(host=host, path=path, connection="keep-alive").encode("ascii") * pipeline
+    writer = None
+    while time.monotonic() < deadline:
+        try:
+            if not writer:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            start = time.perf_counter()
+            writer.write(request)
+            # With pipelining the latency of a request is measured from the moment the batch was sent
+            for _ in range(pipeline):
+                status_code = await asyncio.wait_for(read_response(reader), timeout)
+                stats.record(status_code, time.perf_counter() - start)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as exc:
+            stats.error(exc)
+            if writer:
+                writer.close()
+            writer = None
+    if writer:
+        writer.close()
+
+
+def rss(pid):
+    # Linux only, the resident set size in bytes of another process
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+async def sample_rss(pid, samples, interval=0.1):
+    while True:
+        samples.append(rss(pid))
+        await asyncio.sleep(interval)
+
+
+async def run(mode, host, port, path, connections, duration, pipeline, timeout, pid):
+    stats = Stats()
+    samples = []
+    sampler = asyncio.ensure_future(sample_rss(pid, samples)) if pid else None
+    rss_before = rss(pid) if pid else None
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*[mode(host, port, path, deadline, pipeline, timeout, stats) for _ in range(connections)])
+    elapsed = time.monotonic() - start
+    if sampler:
+        sampler.cancel()
+    samples = [sample for sample in samples if sample is not None]
+    return dict(
+        mode=mode.__name__,
+        connections=connections,
+        pipeline=pipeline,
+        requests=len(stats.latencies),
+        duration=round(elapsed, 3),
+        requests_per_second=round(len(stats.latencies) / elapsed, 1),
+        latency_ms=stats.percentiles(),
+        statuses={str(status_code): count for status_code, count in stats.statuses.items()},
+        errors=dict(stats.errors),
+        server_rss=dict(before=rss_before, peak=max(samples, default=None), after=rss(pid) if pid else None),
+    )
+
+
+async def memory_per_connection(host, port, connections, pid, settle=0.5):
+    """
+    Opens connections to the server and returns the RSS it grew by per connection, once while the
+    connections have not sent a single byte yet and once after each of them was answered and left idle.
+    """
+    request = REQUEST.format(host=host, path="/test_me", connection="keep-alive").encode("ascii")
+    before = rss(pid)
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(await asyncio.open_connection(host, port))
+        await asyncio.sleep(settle)
+        fresh = rss(pid) - before
+        for reader, writer in opened:
+            writer.write(request)
+            await read_response(reader)
+        # Every connection stays open and idle while the server is sampled
+        await asyncio.sleep(settle)
+        idle = rss(pid) - before
+    finally:
+        for reader, writer in opened:
+            writer.close()
+    return fresh / connections, idle / connections
+
+
+def serve(host, port, protocol, record_metrics=True):
+    sol_03.configure(dict(record_metrics=record_metrics))
+    try:
+        asyncio.run(sol_03.main(host, port, protocol))
+    except KeyboardInterrupt:
+        pass
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_result(server, result):
+    latency = result["latency_ms"]
+    rss_peak = result["server_rss"]["peak"]
+    print(f"{server:<20} {result['mode']:<18} {result['requests_per_second']:>10.0f} requests/s  "
+          f"p50 {latency.get('p50', 0):>7.2f}ms  p99 {latency.get('p99', 0):>7.2f}ms  "
+          f"p99.9 {latency.get('p99.9', 0):>7.2f}ms  errors {sum(result['errors'].values()):>5}  "
+          f"rss {rss_peak / 2 ** 20 if rss_peak else 0:>6.1f}MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the asyncio HTTP server of sol_03.py")
+    parser.add_argument("--host", default=sol_03.host)
+    parser.add_argument("--port", type=int, default=sol_03.port)
+    parser.add_argument("--path", default="/test_me")
+    parser.add_argument("--servers", nargs="+", choices=["streams", "protocol"], default=["streams", "protocol"])
+    parser.add_argument("--metrics", nargs="+", choices=["on", "off"], default=["on"],
+                        help="Run with and without recording metrics to measure their overhead")
+    parser.add_argument("--modes", nargs="+", choices=["keep-alive", "close"], default=["close", "keep-alive"])
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--pipeline", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--idle-connections", type=int, default=1000,
+                        help="Idle keep-alive connections to open to measure the memory per connection, 0 to skip")
+    parser.add_argument("--max-bytes-per-connection", type=int,
+                        help="Exit with an error when an idle connection costs the server more RSS than this")
+    parser.add_argument("--external", action="store_true",
+                        help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--pid", type=int, help="Process id of the external server to sample its RSS")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    modes = {"keep-alive": keep_alive, "close": close_per_request}
+    report = dict(
+        revision=git_revision(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        arguments=vars(args),
+        results=[],
+    )
+    runs = [("external", None)] if args.external else [
+        (server, metrics) for server in args.servers for metrics in args.metrics
+    ]
+    failures = []
+    for server_name, metrics in runs:
+        name = server_name if metrics != "off" else f"{server_name}/nometrics"
+        server = None
+        pid = args.pid
+        if not args.external:
+            # A spawned server starts from a clean heap, a forked one would reuse the memory the benchmark
+            # freed and hide what the connections cost
+            server = get_context("spawn").Process(target=serve, args=(args.host, args.port, server_name == "protocol", metrics == "on"))
+            server.start()
+            pid = server.pid
+            time.sleep(1)
+        try:
+            # Measured first, memory freed by a load run would hide the growth
+            if args.idle_connections and pid:
+                fresh, idle = asyncio.run(memory_per_connection(args.host, args.port, args.idle_connections, pid))
+                for mode, per_connection in (("fresh", fresh), ("idle", idle)):
+                    report["results"].append(dict(server=server_name, metrics=metrics, mode=mode,
+                                                  connections=args.idle_connections,
+                                                  bytes_per_connection=round(per_connection)))
+                    print(f"{name:<20} {mode + ' connection':<18} {per_connection:>10.0f} bytes")
+                    if args.max_bytes_per_connection and per_connection > args.max_bytes_per_connection:
+                        failures.append(f"{name} {mode} connection costs {per_connection:.0f} bytes, "
+                                        f"more than {args.max_bytes_per_connection}")
+            for mode in args.modes:
+                result = asyncio.run(run(modes[mode], args.host, args.port, args.path, args.connections,
+                                         args.duration, args.pipeline, args.timeout, pid))
+                result["server"] = server_name
+                result["metrics"] = metrics
+                report["results"].append(result)
+                print_result(name, result)
+        finally:
+            if server:
+                server.terminate()
+                server.join()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import argparse
+import timeit
+
+from chapter_09.sol_03 import Router
+
+
+async def handler(server, request):
+    pass
+
+
+def build(route_count):
+    router = Router()
+    for i in range(route_count):
+        router.add("GET", f"/static/{i}", handler)
+        router.add("GET", f"/users{i}/{{id}}/posts/{{post}}", handler)
+    return router
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the lookup cost of the router against the number of routes")
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    args = parser.parse_args()
+
+    print(f"{'routes':>8} {'static':>12} {'parameters':>12} {'miss':>12}")
+    for route_count in args.counts:
+        router = build(route_count)
+        last = route_count - 1
+        timings = [
+            timeit.timeit(lambda: router.match("GET", path), number=args.number) / args.number * 1e9
+            for path in (f"/static/{last}", f"/users{last}/42/posts/7", f"/users{last}/42/comments/7")
+        ]
+        print(f"{route_count * 2:>8}" + "".join(f"{timing:>10.0f}ns" for timing in timings))
+
+
+if __name__ == '__main__':
+    main()